@@ -1,6 +1,9 @@
-from fastapi import FastAPI
+import os
+from threading import Lock
+
+from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from .parser import get_wrapped_stats
+from .parser import FILE_PATH, get_wrapped_stats
 
 app = FastAPI()
 
@@ -9,8 +12,31 @@ app.add_middleware(
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
 
+# Stats for the current export only, keyed by its ETag (mtime + size); a new export replaces the entry
+_cache: dict[str, dict] = {}
+_cache_lock = Lock()
+
 @app.get("/wrapped")
-def wrapped_data():
-    return get_wrapped_stats()
+def wrapped_data(request: Request, response: Response):
+    stat = os.stat(FILE_PATH)
+    etag = f'"{stat.st_mtime_ns}-{stat.st_size}"'
+
+    # Browser already has this export's stats (If-None-Match may list several tags, possibly weak)
+    sent_etags = {tag.strip().removeprefix("W/") for tag in request.headers.get("if-none-match", "").split(",")}
+    if etag in sent_etags or "*" in sent_etags:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    # Concurrent first requests wait for one parse instead of each running their own;
+    # the result is read under the lock so a newer export can't evict it in between
+    with _cache_lock:
+        result = _cache.get(etag)
+        if result is None:
+            result = get_wrapped_stats()
+            _cache.clear()
+            _cache[etag] = result
+
+    response.headers["ETag"] = etag
+    return result
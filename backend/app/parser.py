@@ -1,27 +1,88 @@
-import xml.etree.ElementTree as ET
-import pandas as pd
-from datetime import datetime, timedelta
+from lxml import etree as ET
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
 from collections import defaultdict
+from types import SimpleNamespace
+from functools import lru_cache
+from itertools import repeat
+from array import array
 import calendar
+import mmap
+import multiprocessing
+import os
 import numpy as np
 
 # --- Configuration ---
 FILE_PATH = "export.xml"
 WRAPPED_YEAR = 2025
 
+# Exports at least this large are split into byte ranges and parsed in PARSE_WORKERS processes
+PARALLEL_MIN_BYTES = 64 * 1024 * 1024
+# CPUs this process may actually run on (respects affinity / cpusets, unlike os.cpu_count())
+PARSE_WORKERS = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+PARSE_MP_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+# How far back to look for an enclosing <Correlation> when choosing a split point
+CORRELATION_SCAN_BYTES = 64 * 1024
+# Size of each mmap slice a worker feeds to its parser
+READ_CHUNK_BYTES = 1024 * 1024
+
+# Sleep analysis values we keep, as small int codes (Awake is 0, every Asleep stage is >= 1).
+# "InBed" is deliberately absent so it is skipped.
+SLEEP_STAGE_CODES = {
+    "HKCategoryValueSleepAnalysisAwake": 0,
+    "HKCategoryValueSleepAnalysisAsleepCore": 1,
+    "HKCategoryValueSleepAnalysisAsleepREM": 2,
+    "HKCategoryValueSleepAnalysisAsleepDeep": 3,
+    "HKCategoryValueSleepAnalysisAsleepUnspecified": 4,
+    "HKCategoryValueSleepAnalysisAsleep": 4,  # Pre-iOS 16 exports
+}
+
+# Unit conversion factors (lower-cased unit -> multiplier); unknown units are assumed km / kcal
+UNIT_TO_KM = {
+    "km": 1.0,
+    "m": 1e-3, "meter": 1e-3, "meters": 1e-3,
+    "mi": 1.60934, "mile": 1.60934, "miles": 1.60934,
+}
+UNIT_ENERGY_TO_KCAL = {
+    "kcal": 1.0,
+    "cal": 1.0,  # Apple's "Cal" is the dietary calorie, i.e. kcal
+    "kj": 1 / 4.184,  # 1 kcal = 4.184 kJ
+    "j": 1 / 4184.0,
+}
+
 # --- Utility Functions ---
 
+@lru_cache(maxsize=None)
+def parse_utc_offset(offset: str):
+    """Returns a shared fixed-offset timezone for a '+HHMM' / '-HHMM' string."""
+    sign = -1 if offset[0] == "-" else 1
+    return timezone(sign * timedelta(hours=int(offset[1:3]), minutes=int(offset[3:5])))
+
+@lru_cache(maxsize=1 << 16)
 def parse_date(dt: str):
     """Parses date string safely."""
     try:
+        # Fast path for Apple Health's fixed 'YYYY-MM-DD HH:MM:SS +HHMM' layout
+        if len(dt) == 25 and dt[19] == " ":
+            return datetime(
+                int(dt[0:4]), int(dt[5:7]), int(dt[8:10]),
+                int(dt[11:13]), int(dt[14:16]), int(dt[17:19]),
+                tzinfo=parse_utc_offset(dt[20:25]),
+            )
         # Handles Apple Health's optional 'Z' and Timezone format
         return datetime.fromisoformat(dt.replace("Z", "+00:00"))
     except Exception:
         return None
 
+def date_key(dt):
+    """Formats a datetime as 'YYYY-MM-DD' from its int fields (much cheaper than strftime)."""
+    return f"{dt.year:04d}-{dt.month:02d}-{dt.day:02d}"
+
 def determine_sleep_day(end_date):
     """Defines the 'Sleep Day' as the calendar date the sleep period ended."""
-    return end_date.strftime('%Y-%m-%d')
+    return date_key(end_date)
 
 def time_to_seconds_of_day(dt_obj):
     """Converts a datetime object to seconds since midnight, adjusted for bedtime."""
@@ -31,291 +92,403 @@ def time_to_seconds_of_day(dt_obj):
         seconds += 86400
     return seconds
 
+@lru_cache(maxsize=24 * 60)
+def minute_of_day_to_time_str(minute):
+    """Formats a minute of the day (0-1439) as a 12-hour 'HH:MM AM' string."""
+    return (datetime.min + timedelta(minutes=minute)).strftime('%I:%M %p')
+
 def seconds_to_time_str(seconds):
     """Converts adjusted seconds back to a HH:MM:SS time string."""
-    # Modulo 86400 ensures the time is within a 24-hour day cycle
-    return (datetime.min + timedelta(seconds=int(seconds) % 86400)).strftime('%I:%M %p')
+    # Modulo 86400 ensures the time is within a 24-hour day cycle; the output only has minute resolution
+    return minute_of_day_to_time_str(int(seconds) % 86400 // 60)
+
+def monthly_totals(months, values):
+    """Sums packed per-record values into {month: total} buckets with a single np.bincount."""
+    months = np.frombuffer(months, dtype=np.int8)
+    counts = np.bincount(months, minlength=13)
+    totals = np.bincount(months, weights=np.asarray(values, dtype=np.float64), minlength=13)
+    return {int(m): float(totals[m]) for m in np.flatnonzero(counts)}
+
+def release_element(elem):
+    """Clears a processed element and drops already-parsed siblings so the tree stays small."""
+    elem.clear()
+    while elem.getprevious() is not None:
+        del elem.getparent()[0]
 
 # ----------------------------------------------------------------------------
-# CORE WRAPPED FUNCTION
+# ELEMENT HANDLERS (Records are keyed by type, see RECORD_HANDLERS)
 # ----------------------------------------------------------------------------
 
-def get_wrapped_stats():
-    # --- Data Containers ---
-    steps_total = 0
-    steps_monthly = defaultdict(int)
+def handle_steps(elem, start_dt, end_dt, value, state):
+    """Adds step counts to the yearly and monthly totals."""
+    if start_dt.year == WRAPPED_YEAR:
+        state.step_months.append(start_dt.month)
+        state.step_counts.append(int(float(value)))
+
+def handle_distance(elem, start_dt, end_dt, value, state):
+    """Adds walking/running distance, normalised to km."""
+    if start_dt.year == WRAPPED_YEAR:
+        raw = float(value)
+        unit = elem.attrib.get("unit", "").lower()
+
+        state.distance_months.append(start_dt.month)
+        state.distance_km.append(raw * UNIT_TO_KM.get(unit, 1.0))
+        state.distance_by_unit[unit or "unknown"] += raw
+
+def handle_flights(elem, start_dt, end_dt, value, state):
+    """Adds flights climbed."""
+    if start_dt.year == WRAPPED_YEAR:
+        state.flights_total += int(float(value))
+
+def handle_stand_hour(elem, start_dt, end_dt, value, state):
+    """Counts hours where the user stood."""
+    if start_dt.year == WRAPPED_YEAR:
+        if "Stood" in value:
+            state.stand_total += 1
+
+def handle_resting_hr(elem, start_dt, end_dt, value, state):
+    """Collects resting heart rate samples."""
+    if start_dt.year == WRAPPED_YEAR:
+        state.resting_hr_values.append(float(value))
+
+def handle_sleep(elem, start_dt, end_dt, value, state):
+    """Collects all raw sleep segments."""
+    code = SLEEP_STAGE_CODES.get(value)
+
+    # Only real sleep categories (Asleep/Awake), not "InBed"
+    if code is not None:
+        state.sleep_starts.append(start_dt.timestamp())
+        state.sleep_ends.append(end_dt.timestamp())
+        state.sleep_codes.append(code)
+        state.sleep_start_tz.append(start_dt.tzinfo)
+        state.sleep_end_tz.append(end_dt.tzinfo)
+        # Calculate net time slept for monthly aggregation
+        if code >= 1:
+            state.sleep_monthly_hours[start_dt.month] += (end_dt - start_dt).total_seconds() / 3600.0
+
+def handle_heart_rate(elem, start_dt, end_dt, value, state):
+    """Buffers HR samples; they are matched to workouts once the whole file is read."""
+    state.hr_sample_times.append(start_dt.timestamp())
+    state.hr_sample_bpm.append(float(value))
+
+def handle_workout(elem, state):
+    """Parses a Workout and its WorkoutStatistics (distance, energy)."""
+    wtype = elem.attrib.get("workoutActivityType", "")
+    start_dt = parse_date(elem.attrib.get("startDate", ""))
+    end_dt = parse_date(elem.attrib.get("endDate", ""))
+
+    if not start_dt or start_dt.year != WRAPPED_YEAR:
+        return
+
+    duration_min = float(elem.attrib.get("duration", 0) or 0)
+    duration_sec = duration_min * 60.0
+
+    workout = {
+        "type": wtype,
+        "start": start_dt,
+        "end": end_dt,
+        "distance_km": 0.0,
+        "duration_sec": duration_sec,
+    }
 
-    distance_total_km = 0.0
-    distance_monthly_km = defaultdict(float)
-    distance_record_count = 0
-    distance_by_unit = defaultdict(float)
+    # libxml2 filters the children by tag; the whole Workout is cleared by release_element
+    for child in elem.iterchildren("WorkoutStatistics"):
+        qtype = child.attrib.get("type", "")
+        if "DistanceWalkingRunning" in qtype:
+            raw = float(child.attrib.get("sum", 0) or 0)
+            unit = child.attrib.get("unit", "").lower()
+            workout["distance_km"] = raw * UNIT_TO_KM.get(unit, 1.0)
+        # Attempt to capture workout energy (calories)
+        if "energy" in qtype.lower() or "activeenergy" in qtype.lower() or "energyburned" in qtype.lower():
+            try:
+                raw_energy = float(child.attrib.get("sum", 0) or 0)
+                unit_e = child.attrib.get("unit", "").lower()
+                workout["calories_kcal"] = raw_energy * UNIT_ENERGY_TO_KCAL.get(unit_e, 1.0)
+            except Exception:
+                pass
+
+    state.workouts.append(workout)
+    # Track monthly workout count
+    state.workouts_monthly[start_dt.month] += 1
+    # Track daily calories burned
+    if "calories_kcal" in workout:
+        state.workouts_daily_calories[date_key(start_dt)] += workout["calories_kcal"]
+
+# Top-level elements the parse loop reacts to; libxml2 filters everything else before Python sees it
+PARSED_TAGS = ("Record", "Workout")
+
+RECORD_HANDLERS = {
+    "HKQuantityTypeIdentifierStepCount": handle_steps,
+    "HKQuantityTypeIdentifierDistanceWalkingRunning": handle_distance,
+    "HKQuantityTypeIdentifierFlightsClimbed": handle_flights,
+    "HKCategoryTypeIdentifierAppleStandHour": handle_stand_hour,
+    "HKQuantityTypeIdentifierRestingHeartRate": handle_resting_hr,
+    "HKCategoryTypeIdentifierSleepAnalysis": handle_sleep,
+    "HKQuantityTypeIdentifierHeartRate": handle_heart_rate,
+}
 
-    flights_total = 0
+# ----------------------------------------------------------------------------
+# PARSING (whole file, or one byte range of it per worker process)
+# ----------------------------------------------------------------------------
 
-    # SLEEP: Store all raw sleep analysis segments (Core, REM, Awake, Deep) for consolidation
-    raw_sleep_segments = [] 
-    sleep_monthly_hours = defaultdict(float) # Net sleep hours per month
+def new_parse_state():
+    """Creates the accumulators that handle_workout and the Record handlers fill in."""
+    return SimpleNamespace(
+        # STEPS / DISTANCE: one (month, value) pair per record, bucketed by monthly_totals() after the parse
+        step_months=array('b'),
+        step_counts=array('q'),
+        distance_months=array('b'),
+        distance_km=array('d'),
+        distance_by_unit=defaultdict(float),
+
+        flights_total=0,
+        stand_total=0.0,
+
+        # SLEEP: Raw sleep analysis segments (Core, REM, Awake, Deep) as parallel columns for consolidation.
+        # Epoch seconds + SLEEP_STAGE_CODES; the tzinfo columns let local bed/wake times be rebuilt later.
+        sleep_starts=[],
+        sleep_ends=[],
+        sleep_codes=[],
+        sleep_start_tz=[],
+        sleep_end_tz=[],
+        sleep_monthly_hours=defaultdict(float),  # Net sleep hours per month
+
+        # HR
+        # HR streams are packed doubles: 8 B per sample instead of a boxed float per list slot
+        resting_hr_values=array('d'),
+        # Epoch-second timestamps and bpm, buffered until every workout has been seen
+        hr_sample_times=array('d'),
+        hr_sample_bpm=array('d'),
+
+        # WORKOUTS
+        # each workout dict may get a 'calories_kcal' key when its WorkoutStatistics report energy
+        workouts=[],
+        workouts_monthly=defaultdict(int),  # Count of workouts per month
+        workouts_daily_calories=defaultdict(float),  # Calories burned per day
+    )
+
+def merge_parse_states(states):
+    """Combines per-range parse states, in file order, into one."""
+    merged = new_parse_state()
+    for part in states:
+        for name, value in vars(part).items():
+            total = getattr(merged, name)
+            if isinstance(total, dict):
+                for key, v in value.items():
+                    total[key] += v
+            elif isinstance(total, (list, array)):
+                total.extend(value)
+            else:
+                setattr(merged, name, total + value)
+    return merged
+
+def parse_export(events):
+    """Accumulates Workouts and Records (Sleep, HR, steps, distance, etc.) from (event, element) pairs."""
+    state = new_parse_state()
+
+    for _, elem in events:
+        if elem.tag == "Workout":
+            handle_workout(elem, state)
+
+        elif elem.tag == "Record":
+            handler = RECORD_HANDLERS.get(elem.attrib.get("type", ""))
+            if handler is None:
+                release_element(elem)
+                continue
 
-    # HR
-    resting_hr_values = []
-    workout_hr_values = []
+            start_dt = parse_date(elem.attrib.get("startDate", ""))
+            end_dt = parse_date(elem.attrib.get("endDate", ""))
+
+            if not start_dt or not end_dt:
+                release_element(elem)
+                continue
+        
+            # Skip if record doesn't fall in or touch the WRAPPED_YEAR
+            if start_dt.year != WRAPPED_YEAR and end_dt.year != WRAPPED_YEAR:
+                release_element(elem)
+                continue
+
+            handler(elem, start_dt, end_dt, elem.attrib.get("value", ""), state)
+
+        release_element(elem)
+
+    return state
+
+def next_element_start(mm, pos, end):
+    """Finds the first top-level <Record>/<Workout> at or after pos (never one nested in a Correlation)."""
+    while pos < end:
+        starts = [i for i in (mm.find(b"<Record ", pos, end), mm.find(b"<Workout ", pos, end)) if i != -1]
+        if not starts:
+            return end
+        pos = min(starts)
+        # Correlations (blood pressure, food) wrap a few Records; never cut inside one
+        opened = mm.rfind(b"<Correlation ", max(0, pos - CORRELATION_SCAN_BYTES), pos)
+        if opened == -1 or mm.find(b"</Correlation>", opened, pos) != -1:
+            return pos
+        closed = mm.find(b"</Correlation>", pos, end)
+        if closed == -1:
+            return end
+        pos = closed + len(b"</Correlation>")
+    return end
+
+def split_export(file_path, parts):
+    """Splits the export body into up to `parts` byte ranges, each made of whole top-level elements."""
+    with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        root = mm.find(b"<HealthData")
+        body_end = mm.rfind(b"</HealthData>")
+        if root == -1 or body_end == -1:
+            return []
+        body_start = mm.find(b">", root) + 1
+
+        cuts = [body_start]
+        for k in range(1, parts):
+            cut = next_element_start(mm, body_start + (body_end - body_start) * k // parts, body_end)
+            if cuts[-1] < cut < body_end:
+                cuts.append(cut)
+        cuts.append(body_end)
+    return list(zip(cuts, cuts[1:]))
+
+def iter_export_range(file_path, start, end):
+    """Yields end events for bytes [start, end) of the export, fed from an mmap under a synthetic root."""
+    parser = ET.XMLPullParser(events=("end",), tag=PARSED_TAGS)
+    with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        parser.feed(b"<HealthData>")
+        for pos in range(start, end, READ_CHUNK_BYTES):
+            parser.feed(mm[pos:min(pos + READ_CHUNK_BYTES, end)])
+            yield from parser.read_events()
+        parser.feed(b"</HealthData>")
+        parser.close()
+        yield from parser.read_events()
+
+def parse_export_range(file_path, start, end):
+    """Worker entry point: parses bytes [start, end) of the export."""
+    return parse_export(iter_export_range(file_path, start, end))
+
+# ----------------------------------------------------------------------------
+# CORE WRAPPED FUNCTION
+# ----------------------------------------------------------------------------
 
-    # WORKOUTS
-    workouts = []
-    workouts_monthly = defaultdict(int)  # Count of workouts per month
-    workouts_daily_calories = defaultdict(float)  # Calories burned per day
+def get_wrapped_stats():
+    # --- Parse (in parallel byte ranges for large exports) ---
+    ranges = split_export(FILE_PATH, PARSE_WORKERS) if os.path.getsize(FILE_PATH) >= PARALLEL_MIN_BYTES else []
+    if len(ranges) > 1:
+        range_starts, range_ends = zip(*ranges)
+        # Called from the server's threadpool: forking a multi-threaded process can deadlock,
+        # so workers come from a forkserver (or spawn where that is unavailable)
+        with ProcessPoolExecutor(max_workers=len(ranges), mp_context=PARSE_MP_CONTEXT) as pool:
+            state = merge_parse_states(pool.map(parse_export_range, repeat(FILE_PATH), range_starts, range_ends))
+    else:
+        # libxml2 reads the file itself here, already in large C-level buffered reads
+        state = parse_export(ET.iterparse(FILE_PATH, events=("end",), tag=PARSED_TAGS))
+
+    workouts = state.workouts
     total_runs = 0
-    run_distances = []
-    run_paces = []
+    run_distances = array('d')
+    run_paces = array('d')
     longest_run_km = 0.0
     fastest_pace = None
-    # calories per workout (kcal)
-    # will be filled when parsing WorkoutStatistics
-    # each workout dict may get a 'calories_kcal' key
 
     # RINGS (Placeholders)
     move_total = 0.0
     exercise_total = 0.0
-    stand_total = 0.0
-    
-    # --- PASS 1 — Workouts (to be associated with HR data later) ---
-    for event, elem in ET.iterparse(FILE_PATH, events=("start", "end")):
-        if elem.tag == "Workout" and event == "start":
-            wtype = elem.attrib.get("workoutActivityType", "")
-            start_dt = parse_date(elem.attrib.get("startDate", ""))
-            end_dt = parse_date(elem.attrib.get("endDate", ""))
-
-            if not start_dt or start_dt.year != WRAPPED_YEAR:
-                elem.clear()
-                continue
 
-            duration_min = float(elem.attrib.get("duration", 0) or 0)
-            duration_sec = duration_min * 60.0
-
-            workout = {
-                "type": wtype,
-                "start": start_dt,
-                "end": end_dt,
-                "distance_km": 0.0,
-                "duration_sec": duration_sec,
-            }
-
-            for child in list(elem):
-                if child.tag == "WorkoutStatistics":
-                    qtype = child.attrib.get("type", "")
-                    if "DistanceWalkingRunning" in qtype:
-                        raw = float(child.attrib.get("sum", 0) or 0)
-                        unit = child.attrib.get("unit", "").lower()
-                        
-                        km = raw # Assume km unless otherwise specified
-                        if unit == "m":
-                            km = raw / 1000
-                        elif unit == "mi":
-                            km = raw * 1.60934
-                            
-                        workout["distance_km"] = km
-                    # Attempt to capture workout energy (calories)
-                    if "energy" in qtype.lower() or "activeenergy" in qtype.lower() or "energyburned" in qtype.lower():
-                        try:
-                            raw_energy = float(child.attrib.get("sum", 0) or 0)
-                            unit_e = child.attrib.get("unit", "").lower()
-                            kcal = raw_energy
-                            if unit_e and "kcal" in unit_e:
-                                kcal = raw_energy
-                            elif unit_e and ("kj" in unit_e):
-                                # kJ -> kcal (1 kcal = 4.184 kJ)
-                                kcal = raw_energy / 4.184
-                            elif unit_e and ("j" in unit_e):
-                                # J -> kcal
-                                kcal = raw_energy / 4184.0
-                            else:
-                                # Unknown unit: assume kcal
-                                kcal = raw_energy
-                            workout["calories_kcal"] = kcal
-                        except Exception:
-                            pass
-
-                child.clear()
-            workouts.append(workout)
-            # Track monthly workout count
-            workouts_monthly[start_dt.month] += 1
-            # Track daily calories burned
-            workout_date_str = start_dt.strftime('%Y-%m-%d')
-            if "calories_kcal" in workout:
-                workouts_daily_calories[workout_date_str] += workout["calories_kcal"]
-
-        elem.clear()
-    
-    # --- PASS 2 — Records (Sleep, HR, steps, distance, etc.) ---
-    # Re-read or rewind the file iterator for Pass 2
-    for event, elem in ET.iterparse(FILE_PATH, events=("start", "end")):
-        if elem.tag == "Record" and event == "start":
-            rtype = elem.attrib.get("type", "")
-            value = elem.attrib.get("value", "")
-            start_dt = parse_date(elem.attrib.get("startDate", ""))
-            end_dt = parse_date(elem.attrib.get("endDate", ""))
+    # --- HR DURING WORKOUT (Workouts come after Records in the export, so match once all are known) ---
+    workouts.sort(key=lambda w: w["start"])
+    sample_times = np.frombuffer(state.hr_sample_times, dtype=np.float64)
+    sample_bpm = np.frombuffer(state.hr_sample_bpm, dtype=np.float64)
+    if workouts:
+        workout_starts = np.array([w["start"].timestamp() for w in workouts])
+        # Latest end among workouts started so far, so overlapping workouts are still covered
+        workout_ends = np.maximum.accumulate(np.array([w["end"].timestamp() for w in workouts]))
+        # One C-level merge of all samples against the sorted workout starts
+        idx = np.searchsorted(workout_starts, sample_times, side="right") - 1
+        in_workout = (idx >= 0) & (sample_times <= workout_ends[np.maximum(idx, 0)])
+        workout_hr_values = sample_bpm[in_workout]
+    else:
+        workout_hr_values = sample_bpm[:0]
+
+    # --- MONTHLY STEP / DISTANCE BUCKETS ---
+    steps_monthly = {m: int(v) for m, v in monthly_totals(state.step_months, state.step_counts).items()}
+    steps_total = sum(steps_monthly.values())
+    distance_monthly_km = monthly_totals(state.distance_months, state.distance_km)
+    distance_total_km = sum(distance_monthly_km.values())
 
-            if not start_dt or not end_dt:
-                elem.clear()
-                continue
-            
-            # Skip if record doesn't fall in or touch the WRAPPED_YEAR
-            if not (start_dt.year == WRAPPED_YEAR or end_dt.year == WRAPPED_YEAR):
-                elem.clear()
-                continue
-            
-            # ---------- STEPS ----------
-            if rtype == "HKQuantityTypeIdentifierStepCount":
-                if start_dt.year == WRAPPED_YEAR:
-                    v = int(float(value))
-                    steps_total += v
-                    steps_monthly[start_dt.month] += v
-
-            # ---------- DISTANCE ----------
-            if rtype == "HKQuantityTypeIdentifierDistanceWalkingRunning":
-                if start_dt.year == WRAPPED_YEAR:
-                    raw = float(value)
-                    unit = elem.attrib.get("unit", "").lower()
-
-                    km = raw # Assume km unless otherwise specified
-                    if unit in ["m", "meter", "meters"]:
-                        km = raw / 1000.0
-                    elif unit in ["mi", "mile", "miles"]:
-                        km = raw * 1.60934
-
-                    distance_total_km += km
-                    distance_monthly_km[start_dt.month] += km
-                    distance_record_count += 1
-                    distance_by_unit[unit or "unknown"] += raw
-
-            # ---------- FLIGHTS ----------
-            if rtype == "HKQuantityTypeIdentifierFlightsClimbed":
-                if start_dt.year == WRAPPED_YEAR:
-                    flights_total += int(float(value))
-
-            # ---------- STAND HOURS ----------
-            if rtype == "HKCategoryTypeIdentifierAppleStandHour":
-                if start_dt.year == WRAPPED_YEAR:
-                    if "Stood" in value:
-                        stand_total += 1
-
-            # ---------- RESTING HR ----------
-            if rtype == "HKQuantityTypeIdentifierRestingHeartRate":
-                if start_dt.year == WRAPPED_YEAR:
-                    resting_hr_values.append(float(value))
-
-            # ---------- SLEEP (Collect all raw segments) ----------
-            if rtype == "HKCategoryTypeIdentifierSleepAnalysis":
-                category = elem.attrib.get("value", "")
-                
-                # Only real sleep categories (Asleep/Awake), not "InBed"
-                if "Asleep" in category or "Awake" in category: 
-                    raw_sleep_segments.append({
-                        'start': start_dt, 
-                        'end': end_dt, 
-                        'value': category
-                    })
-                    # Calculate net time slept for monthly aggregation
-                    if 'Asleep' in category:
-                        sleep_monthly_hours[start_dt.month] += (end_dt - start_dt).total_seconds() / 3600.0
-
-            # ---------- HR DURING WORKOUT ----------
-            if rtype == "HKQuantityTypeIdentifierHeartRate":
-                hr = float(value)
-                if start_dt:
-                    for w in workouts:
-                        if w["start"] <= start_dt <= w["end"]:
-                            workout_hr_values.append(hr)
-                            break
-
-            elem.clear()
-    
     # ----------------------------------------------------------------------------
     # CONSOLIDATED SLEEP ANALYSIS
     # ----------------------------------------------------------------------------
     
     sleep_results = {}
     
-    if raw_sleep_segments:
-        df = pd.DataFrame(raw_sleep_segments)
-        df = df.sort_values("end").reset_index(drop=True)
+    if state.sleep_starts:
+        n_segments = len(state.sleep_starts)
+        starts = np.asarray(state.sleep_starts, dtype=np.float64)
+        ends = np.asarray(state.sleep_ends, dtype=np.float64)
+        codes = np.asarray(state.sleep_codes, dtype=np.int8)
+        is_asleep = codes >= 1
+        is_awake = codes == 0
+
+        order = np.argsort(ends, kind='stable')
+        starts, ends, is_asleep, is_awake = starts[order], ends[order], is_asleep[order], is_awake[order]
         
         # Consolidation Logic: New period starts if gap > 6 hours
         MAX_INTERRUPTION_HOURS = 6.0 
-        df['Time_Since_Last'] = (df['start'] - df['end'].shift(1)).dt.total_seconds() / 3600
-        df['Is_New_Period'] = (df['Time_Since_Last'].fillna(MAX_INTERRUPTION_HOURS + 0.1) > MAX_INTERRUPTION_HOURS)
-        df['Period_ID'] = df['Is_New_Period'].cumsum()
-        
-        grouped_periods = df.groupby('Period_ID')
+        gaps = starts[1:] - ends[:-1]
+        is_new_period = np.concatenate(([True], gaps > MAX_INTERRUPTION_HOURS * 3600))
+        period_ids = np.cumsum(is_new_period) - 1
+        boundaries = np.flatnonzero(is_new_period)
+
+        # Segment indices holding each period's earliest start and latest end
+        first_idx = order[np.lexsort((starts, period_ids))[boundaries]]
+        last_idx = order[np.append(boundaries[1:], n_segments) - 1]
+
+        # Per-period net sleep (sum of Asleep segments), awakenings (count of Awake segments) and block length
+        net_sleep_hours = np.add.reduceat((ends - starts) * is_asleep, boundaries) / 3600.0
+        awake_counts = np.add.reduceat(is_awake.astype(np.int64), boundaries)
+        block_duration_hours = (np.maximum.reduceat(ends, boundaries) - np.minimum.reduceat(starts, boundaries)) / 3600.0
         
         # Containers for Final Sleep Stats
-        consolidated_nights = []
+        dates_woke = []
         all_bedtimes_sec = []
         all_waketimes_sec = []
-        total_net_sleep_hours = 0.0
 
-        for period_id, group in grouped_periods:
-            period_start = group['start'].min()
-            period_end = group['end'].max()
-            
-            # Net sleep duration (sum of Asleep segments)
-            net_sleep_duration_sec = group[group['value'].str.contains('Asleep')]['end'].sub(
-                group[group['value'].str.contains('Asleep')]['start']
-            ).dt.total_seconds().sum()
-            
-            net_sleep_hours = net_sleep_duration_sec / 3600.0
-            total_block_duration_hours = (period_end - period_start).total_seconds() / 3600
-            
-            # Awakenings (count of Awake segments)
-            awake_count = len(group[group['value'].str.contains('Awake', na=False)])
+        for i, j in zip(first_idx.tolist(), last_idx.tolist()):
+            period_start = datetime.fromtimestamp(state.sleep_starts[i], state.sleep_start_tz[i])
+            period_end = datetime.fromtimestamp(state.sleep_ends[j], state.sleep_end_tz[j])
             
             # Compute adjusted seconds for bedtime/waketime and append for final stats
-            bedtime_sec = time_to_seconds_of_day(period_start)
-            waketime_sec = time_to_seconds_of_day(period_end)
-
-            all_bedtimes_sec.append(bedtime_sec)
-            all_waketimes_sec.append(waketime_sec)
-            total_net_sleep_hours += net_sleep_hours
-
-            consolidated_nights.append({
-                'start': period_start,
-                'end': period_end,
-                'net_sleep_hours': net_sleep_hours,
-                'block_duration_hours': total_block_duration_hours,
-                'awake_count': awake_count,
-                'bedtime_sec': bedtime_sec,
-                'waketime_sec': waketime_sec,
-                'date_woke': determine_sleep_day(period_end)
-            })
+            all_bedtimes_sec.append(time_to_seconds_of_day(period_start))
+            all_waketimes_sec.append(time_to_seconds_of_day(period_end))
+            dates_woke.append(determine_sleep_day(period_end))
 
         # --- CALCULATE WRAPPED SLEEP STATS ---
         
-        total_nights_with_data = len(consolidated_nights)
+        total_nights_with_data = len(dates_woke)
         
         # 1. Total & Avg Sleep
+        total_net_sleep_hours = float(net_sleep_hours.sum())
         avg_sleep_per_night = total_net_sleep_hours / total_nights_with_data if total_nights_with_data else 0
         
         # 2. Longest/Shortest Night
-        longest_night = max(consolidated_nights, key=lambda x: x['net_sleep_hours'])
-        shortest_night = min(consolidated_nights, key=lambda x: x['net_sleep_hours'])
+        longest_idx = int(np.argmax(net_sleep_hours))
+        shortest_idx = int(np.argmin(net_sleep_hours))
 
         # 3. Most Awakened Night
-        most_awake_night = max(consolidated_nights, key=lambda x: x['awake_count'])
+        most_awake_idx = int(np.argmax(awake_counts))
         
         # 4. Average Bed/Wake Time (using NumPy mean on adjusted seconds)
         avg_bedtime_sec = np.mean(all_bedtimes_sec) if all_bedtimes_sec else 0
         avg_waketime_sec = np.mean(all_waketimes_sec) if all_waketimes_sec else 0
         
         # 5. Average Sleep Efficiency removed per request
-        total_block_hours = sum(n['block_duration_hours'] for n in consolidated_nights)
+        total_block_hours = float(block_duration_hours.sum())
         
         # Prepare plottable data array for the frontend
         nightly_sleep_data = [{
-            'date': n['date_woke'],
+            'date': date_woke,
             # Convert seconds to decimal hours (needed for the chart's Y-axis scale)
-            'bedtime_h_dec': n['bedtime_sec'] / 3600,
-            'wake_time_h_dec': n['waketime_sec'] / 3600
-        } for n in consolidated_nights]
+            'bedtime_h_dec': bedtime_sec / 3600,
+            'wake_time_h_dec': waketime_sec / 3600
+        } for date_woke, bedtime_sec, waketime_sec in zip(dates_woke, all_bedtimes_sec, all_waketimes_sec)]
 
         sleep_results = {
             "total_net_sleep_hours": round(total_net_sleep_hours, 2),
@@ -326,16 +499,16 @@ def get_wrapped_stats():
             # Removed: avg_sleep_efficiency and total_deep_sleep_min
             
             "longest_sleep_night": {
-                "date_woke": determine_sleep_day(longest_night['end']),
-                "duration_hours": round(longest_night['net_sleep_hours'], 2)
+                "date_woke": dates_woke[longest_idx],
+                "duration_hours": round(float(net_sleep_hours[longest_idx]), 2)
             },
             "shortest_sleep_night": {
-                "date_woke": determine_sleep_day(shortest_night['end']),
-                "duration_hours": round(shortest_night['net_sleep_hours'], 2)
+                "date_woke": dates_woke[shortest_idx],
+                "duration_hours": round(float(net_sleep_hours[shortest_idx]), 2)
             },
             "most_woken_night": {
-                "date_woke": determine_sleep_day(most_awake_night['end']),
-                "awakening_count": most_awake_night['awake_count']
+                "date_woke": dates_woke[most_awake_idx],
+                "awakening_count": int(awake_counts[most_awake_idx])
             }
         ,
             "nightly_sleep_data": nightly_sleep_data
@@ -369,27 +542,28 @@ def get_wrapped_stats():
     total_workout_calories = sum((w.get('calories_kcal', 0) for w in workouts))
     avg_calories_per_workout = (total_workout_calories / workouts_count) if workouts_count else 0
     # Highest/avg BPM during workouts (workout_hr_values collected earlier)
-    highest_workout_bpm = max(workout_hr_values) if workout_hr_values else 0
+    highest_workout_bpm = float(workout_hr_values.max()) if workout_hr_values.size else 0
     
     # Find day with most calories burned
     max_calories_day = None
     max_calories_value = 0.0
-    if workouts_daily_calories:
-        max_calories_day, max_calories_value = max(workouts_daily_calories.items(), key=lambda x: x[1])
+    if state.workouts_daily_calories:
+        max_calories_day, max_calories_value = max(state.workouts_daily_calories.items(), key=lambda x: x[1])
             
     # --------------------------------------
     # FINAL METRICS
     # --------------------------------------
-    resting_hr_avg = sum(resting_hr_values) / len(resting_hr_values) if resting_hr_values else 0
-    workout_hr_avg = sum(workout_hr_values) / len(workout_hr_values) if workout_hr_values else 0
+    # np.frombuffer gives a zero-copy view over the array('d') storage
+    resting_hr_avg = float(np.frombuffer(state.resting_hr_values, dtype=np.float64).mean()) if state.resting_hr_values else 0
+    workout_hr_avg = float(workout_hr_values.mean()) if workout_hr_values.size else 0
 
     return {
         "wrapped_year": WRAPPED_YEAR,
 
         "steps_total": steps_total,
-        "steps_monthly": dict(steps_monthly),
+        "steps_monthly": steps_monthly,
         "distance_total_km": round(distance_total_km, 2),
-        "flights_total": flights_total,
+        "flights_total": state.flights_total,
         
         "resting_hr_avg": round(resting_hr_avg, 1),
         "workout_hr_avg": round(workout_hr_avg, 1),
@@ -411,12 +585,12 @@ def get_wrapped_stats():
 
         # FINAL CONSOLIDATED SLEEP METRICS
         **sleep_results,
-        "sleep_monthly_hours": sleep_monthly_hours,
+        "sleep_monthly_hours": state.sleep_monthly_hours,
         # Workout monthly breakdown
-        "workouts_monthly": dict(workouts_monthly),
+        "workouts_monthly": dict(state.workouts_monthly),
         # Exercise/stand totals (exercise derived from total workout durations as fallback)
         "exercise_total": round(sum(workout_durations_sec) / 60.0, 1),
-        "stand_total": round(stand_total, 1),
+        "stand_total": round(state.stand_total, 1),
     }
 
 # NOTE: No execution or print statements here as requested.
\ No newline at end of file
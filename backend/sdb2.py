@@ -1,4 +1,4 @@
-import xml.etree.ElementTree as ET
+from lxml import etree as ET
 import pandas as pd
 from datetime import datetime, timedelta
 
@@ -24,29 +24,31 @@ def extract_detailed_sleep_periods(file_path, year):
     """
     print(f"Loading data from {file_path}...")
 
-    # Load XML safely
+    raw_records = []
+
+    # 1. Stream Records and keep the sleep analysis ones for Target Year (load XML safely)
     try:
-        tree = ET.parse(file_path)
-        root = tree.getroot()
+        for _, record in ET.iterparse(file_path, events=("end",), tag="Record"):
+            if record.get('type') == SLEEP_TYPE:
+                end_date_str = record.get('endDate')
+
+                if end_date_str:
+                    try:
+                        record_date = datetime.strptime(end_date_str.split(" ")[0], "%Y-%m-%d")
+                        if record_date.year == year:
+                            # Copy: the live attrib mapping is emptied by clear() below
+                            raw_records.append(dict(record.attrib))
+                    except ValueError:
+                        pass
+
+            # Free the record and everything parsed before it so memory stays flat
+            record.clear()
+            while record.getprevious() is not None:
+                del record.getparent()[0]
     except Exception as e:
         print(f"Error loading XML: {e}")
         return
 
-    raw_records = []
-
-    # 1. Extract and Filter Records for Target Year
-    for record in root.iter('Record'):
-        if record.get('type') == SLEEP_TYPE:
-            end_date_str = record.get('endDate')
-            
-            if end_date_str:
-                try:
-                    record_date = datetime.strptime(end_date_str.split(" ")[0], "%Y-%m-%d")
-                    if record_date.year == year:
-                        raw_records.append(record.attrib)
-                except ValueError:
-                    continue
-
     if not raw_records:
         print(f"No sleep analysis records found ending in {year}.")
         return
@@ -54,9 +56,10 @@ def extract_detailed_sleep_periods(file_path, year):
     # 2. Convert to DataFrame and Prepare Dates
     df = pd.DataFrame(raw_records)
     date_format = "%Y-%m-%d %H:%M:%S %z"
-    df["startDate"] = pd.to_datetime(df["startDate"], format=date_format)
-    df["endDate"] = pd.to_datetime(df["endDate"], format=date_format)
-    df["Sleep_Day"] = df["endDate"].apply(determine_sleep_day)
+    # cache=True parses each distinct timestamp string only once
+    df["startDate"] = pd.to_datetime(df["startDate"], format=date_format, cache=True)
+    df["endDate"] = pd.to_datetime(df["endDate"], format=date_format, cache=True)
+    df["Sleep_Day"] = df["endDate"].dt.strftime('%Y-%m-%d')
     
     # --- New Consolidation Logic (Allows for long breaks within a night) ---
     
@@ -74,6 +77,13 @@ def extract_detailed_sleep_periods(file_path, year):
     
     # Assign a unique ID to each continuous sleep period
     df_sorted['Period_ID'] = df_sorted['Is_New_Period'].cumsum()
+
+    # Per-segment output fields, computed for the whole frame at once instead of row by row
+    df_sorted['Duration_Sec'] = (df_sorted['endDate'] - df_sorted['startDate']).dt.total_seconds()
+    df_sorted['Start_Str'] = df_sorted['startDate'].dt.strftime('%Y-%m-%d %H:%M:%S %z')
+    df_sorted['End_Str'] = df_sorted['endDate'].dt.strftime('%Y-%m-%d %H:%M:%S %z')
+    df_sorted['End_Clock'] = df_sorted['endDate'].dt.strftime('%I:%M %p')
+    df_sorted['Is_Awake'] = df_sorted['value'].str.contains('Awake', na=False)
     
     # 4. Aggregate by Period ID and Format Output
 
@@ -93,25 +103,19 @@ def extract_detailed_sleep_periods(file_path, year):
         total_block_duration_hours = (period_end - period_start).total_seconds() / 3600
         
         # --- New Awakening Counter and Times ---
-        awake_events = []
-        
-        # Filter segments that are classified as 'Awake'
-        awake_segments = group[group['value'].str.contains('Awake', na=False)]
-        
-        # For each awake segment, record the end time (when you finished being awake)
-        for _, row in awake_segments.iterrows():
-            awake_events.append(row['endDate'].strftime('%I:%M %p'))
+        # For each 'Awake' segment, record the end time (when you finished being awake)
+        awake_events = group.loc[group['Is_Awake'], 'End_Clock'].tolist()
 
         # Structure the detailed records for the segment summary
-        detailed_segments = []
-        for _, row in group.iterrows():
-            duration_sec = (row['endDate'] - row['startDate']).total_seconds()
-            detailed_segments.append({
-                'value': row['value'],
-                'start': row['startDate'].strftime('%Y-%m-%d %H:%M:%S %z'),
-                'end': row['endDate'].strftime('%Y-%m-%d %H:%M:%S %z'),
-                'duration_min': round(duration_sec / 60, 2)
-            })
+        detailed_segments = [{
+            'value': value,
+            'start': start,
+            'end': end,
+            'duration_min': round(duration_sec / 60, 2)
+        } for value, start, end, duration_sec in zip(
+            group['value'].tolist(), group['Start_Str'].tolist(),
+            group['End_Str'].tolist(), group['Duration_Sec'].tolist()
+        )]
             
         final_sleep_periods.append({
             'Sleep_Period_Key': f"{period_start.strftime('%m-%d %I:%M %p')} --> {period_end.strftime('%m-%d %I:%M %p')}",
@@ -128,38 +132,39 @@ def extract_detailed_sleep_periods(file_path, year):
 
 # --- Execution ---
 
-all_sleep_data = extract_detailed_sleep_periods(XML_FILE_PATH, TARGET_YEAR)
+if __name__ == "__main__":
+    all_sleep_data = extract_detailed_sleep_periods(XML_FILE_PATH, TARGET_YEAR)
 
-if all_sleep_data:
-    print("\n## ✨ Detailed Sleep Periods for 2025")
-    print(f"Total Consolidated Sleep Periods Found: **{len(all_sleep_data)}**")
-    print("---")
+    if all_sleep_data:
+        print("\n## ✨ Detailed Sleep Periods for 2025")
+        print(f"Total Consolidated Sleep Periods Found: **{len(all_sleep_data)}**")
+        print("---")
     
-    # Output the first 5 sleep periods for review
-    print("### 📝 Sample Output (First 5 Sleep Periods):")
-    for i, period in enumerate(all_sleep_data[:5]):
-        print(f"\n--- 🌙 Consolidated Period {i+1} (Woke up {period['Wake_Date']}) ---")
-        print(f"* **Start/End Time:** {period['Bed_Time']} to {period['Wake_Time']}")
-        print(f"* **Total Block Duration:** {period['Total_Block_Duration_Hours']} hours")
-        print(f"* **Times Woke Up (Awake Segments):** {period['Awake_Count']} times")
+        # Output the first 5 sleep periods for review
+        print("### 📝 Sample Output (First 5 Sleep Periods):")
+        for i, period in enumerate(all_sleep_data[:5]):
+            print(f"\n--- 🌙 Consolidated Period {i+1} (Woke up {period['Wake_Date']}) ---")
+            print(f"* **Start/End Time:** {period['Bed_Time']} to {period['Wake_Time']}")
+            print(f"* **Total Block Duration:** {period['Total_Block_Duration_Hours']} hours")
+            print(f"* **Times Woke Up (Awake Segments):** {period['Awake_Count']} times")
         
-        if period['Awake_Count'] > 0:
-            print(f"  - **Awakening Times:** {', '.join(period['Awake_Times'])}")
+            if period['Awake_Count'] > 0:
+                print(f"  - **Awakening Times:** {', '.join(period['Awake_Times'])}")
 
-        # Aggregate segment types for summary
-        summary = {}
-        total_time_asleep_min = 0
+            # Aggregate segment types for summary
+            summary = {}
+            total_time_asleep_min = 0
         
-        for seg in period['Segments']:
-            sleep_type = seg['value'].split('SleepAnalysis')[-1]
-            duration = seg['duration_min']
-            summary[sleep_type] = summary.get(sleep_type, 0) + duration
-            if 'Asleep' in sleep_type:
-                total_time_asleep_min += duration
+            for seg in period['Segments']:
+                sleep_type = seg['value'].split('SleepAnalysis')[-1]
+                duration = seg['duration_min']
+                summary[sleep_type] = summary.get(sleep_type, 0) + duration
+                if 'Asleep' in sleep_type:
+                    total_time_asleep_min += duration
         
-        print(f"* **Total Time Asleep:** {round(total_time_asleep_min / 60, 2)} hours")
-        print(f"Segment Summary (Minutes):")
+            print(f"* **Total Time Asleep:** {round(total_time_asleep_min / 60, 2)} hours")
+            print(f"Segment Summary (Minutes):")
         
-        # Sort and print the segment types
-        for type, duration in sorted(summary.items(), key=lambda item: item[1], reverse=True):
-            print(f"  - **{type}:** {round(duration, 1)} min")
\ No newline at end of file
+            # Sort and print the segment types
+            for type, duration in sorted(summary.items(), key=lambda item: item[1], reverse=True):
+                print(f"  - **{type}:** {round(duration, 1)} min")
\ No newline at end of file
@@ -1,119 +1,183 @@
-import xml.etree.ElementTree as ET
+import glob
+import os
+from lxml import etree as ET
 import pandas as pd
-from datetime import datetime, timedelta
 import numpy as np
 
 # --- Configuration ---
 XML_FILE_PATH = 'export.xml'
 TARGET_YEAR = 2025
 SLEEP_TYPE = 'HKCategoryTypeIdentifierSleepAnalysis'
+MERGE_BUFFER_NS = 5 * 60 * 1_000_000_000  # Segments less than 5 minutes apart belong to the same night
 
 # --- Utility Functions ---
 
-def time_to_adjusted_seconds(t, is_bedtime):
-    """Converts time object to adjusted seconds from midnight for averaging."""
-    seconds = t.hour * 3600 + t.minute * 60 + t.second
-    # Shift bedtime forward 24 hours if it is before noon
-    if is_bedtime and t.hour < 12:
-        seconds += 86400
-    return seconds
+def local_seconds_of_day(times):
+    """Converts a datetime Series (local wall-clock time) to seconds from midnight."""
+    seconds = times.to_numpy().astype("datetime64[s]").astype(np.int64)
+    return seconds % 86400
 
 def seconds_to_time_str(seconds):
     """Converts adjusted seconds back to a HH:MM:SS time string."""
-    return (datetime.min + timedelta(seconds=int(seconds) % 86400)).strftime('%H:%M:%S')
-
-def create_adjusted_bedtime_dt(row):
-    """Creates a date-aware datetime object, shifting post-midnight bedtimes."""
-    dt = row['start']
-    # If sleep starts after midnight (e.g., 1AM), treat it as 25:00 on the previous day's cycle
-    if dt.hour < 12:
-        return dt + timedelta(days=1)
-    return dt
+    hours, remainder = divmod(int(seconds) % 86400, 3600)
+    minutes, secs = divmod(remainder, 60)
+    return f"{hours:02d}:{minutes:02d}:{secs:02d}"
+
+def merge_sleep_segments(start_ns, end_ns, buffer_ns):
+    """Merges segments sorted by start into blocks, returning each block's first segment index, end and segment count."""
+    # A segment opens a new block if it starts after everything before it has ended (plus the buffer).
+    # Starts are sorted, so the running max of the ends is the current block's end.
+    new_block = np.empty(len(start_ns), dtype=bool)
+    new_block[0] = True
+    new_block[1:] = start_ns[1:] > np.maximum.accumulate(end_ns)[:-1] + buffer_ns
+    block_firsts = np.flatnonzero(new_block)
+    block_ends = np.maximum.reduceat(end_ns, block_firsts)
+    segment_counts = np.diff(block_firsts, append=len(start_ns))
+    return block_firsts, block_ends, segment_counts
+
+def most_common_bin(seconds, bin_size):
+    """Returns the most common value after rounding seconds to the nearest bin (ties go to the earliest bin)."""
+    bins, remainder = np.divmod(seconds, bin_size)
+    # Round half to even, matching (S / N).round()
+    bins += (remainder > bin_size / 2) | ((remainder == bin_size / 2) & (bins % 2 == 1))
+    return int(np.bincount(bins).argmax()) * bin_size
+
+def sleep_cache_path(file_path):
+    """Parquet cache next to the export, keyed by its mtime and size so a new export is re-parsed."""
+    stat = os.stat(file_path)
+    return f"{file_path}.sleep-{stat.st_mtime_ns}-{stat.st_size}.parquet"
+
+def write_sleep_cache(df, file_path, cache_path):
+    """Atomically writes the segment cache and removes caches left behind by older exports."""
+    tmp_path = f"{cache_path}.tmp-{os.getpid()}"
+    try:
+        df.to_parquet(tmp_path, compression="zstd")
+        # A run killed mid-write leaves only the temp file, never a truncated cache
+        os.replace(tmp_path, cache_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    for stale_path in glob.glob(f"{glob.escape(file_path)}.sleep-*.parquet"):
+        if stale_path != cache_path:
+            os.remove(stale_path)
+
+def load_sleep_segments(file_path):
+    """Parses every raw asleep segment in the export into a startDate/endDate DataFrame."""
+    starts = []
+    ends = []
+
+    # Stream only <Record> elements; lxml skips every other tag in C, and each record plus
+    # everything parsed before it is freed so memory stays flat
+    for _, record in ET.iterparse(file_path, events=("end",), tag="Record"):
+        # Only include records that indicate the user was actually 'Asleep'
+        # (HKCategoryValueSleepAnalysisAsleep* values)
+        if record.get("type") == SLEEP_TYPE and "Asleep" in record.get("value", ""):
+            start = record.get("startDate")
+            end = record.get("endDate")
+            if start and end:
+                # Keep only "YYYY-MM-DD HH:MM:SS"; everything is analysed in local wall-clock time
+                starts.append(start[:19])
+                ends.append(end[:19])
+
+        record.clear()
+        while record.getprevious() is not None:
+            del record.getparent()[0]
+
+    # NumPy parses the ISO-style strings straight into datetime64, no object columns in between
+    df = pd.DataFrame({
+        "startDate": np.asarray(starts, dtype="datetime64[s]").astype("datetime64[ns]"),
+        "endDate": np.asarray(ends, dtype="datetime64[s]").astype("datetime64[ns]"),
+    })
+
+    # Sorted once here (stable, as the merge expects), so cached segments come back already in order
+    return df.sort_values("startDate", kind="mergesort", ignore_index=True)
 
 def analyze_sleep_data(file_path, year):
 
     print(f"Loading data from {file_path}...")
 
-    # Load XML safely
+    # Parse the XML once per export; later runs (for any year) read the cached segments
     try:
-        tree = ET.parse(file_path)
-        root = tree.getroot()
-    except Exception as e:
-        print(f"Error loading XML: {e}")
+        cache_path = sleep_cache_path(file_path)
+    except OSError as e:
+        print(f"Error loading sleep data: {e}")
         return
 
-    sleep_records = []
-
-    # Extract raw asleep segments (HKCategoryValueSleepAnalysisAsleep* values)
-    for record in root.iter('Record'):
-        if record.get('type') != SLEEP_TYPE:
-            continue
-
-        value = record.get("value", "")
-        # Only include records that indicate the user was actually 'Asleep'
-        if "Asleep" not in value:
-            continue
+    df = None
+    if os.path.exists(cache_path):
+        try:
+            df = pd.read_parquet(cache_path)
+        except Exception as e:
+            # Unreadable cache (e.g. from an interrupted older run): drop it and re-parse
+            print(f"Ignoring unreadable sleep cache {cache_path}: {e}")
+            os.remove(cache_path)
 
-        start = record.get("startDate")
-        end = record.get("endDate")
-        if not start or not end:
-            continue
+    if df is None:
+        try:
+            df = load_sleep_segments(file_path)
+        except Exception as e:
+            print(f"Error loading XML: {e}")
+            return
 
+        # The cache only saves time on the next run, so failing to write it is not fatal
         try:
-            end_year = datetime.strptime(end.split(" ")[0], "%Y-%m-%d").year
-        except ValueError:
-            continue
-            
-        if end_year != year:
-            continue
+            write_sleep_cache(df, file_path, cache_path)
+        except Exception as e:
+            print(f"Warning: could not write sleep cache {cache_path}: {e}")
 
-        sleep_records.append(record.attrib)
+    # Keep segments that end (wake up) in the target year; times are local, so are the year bounds
+    year_start = np.datetime64(f"{year}-01-01", "ns")
+    year_end = np.datetime64(f"{year + 1}-01-01", "ns")
+    end_dates = df["endDate"].to_numpy()
+    df = df[(end_dates >= year_start) & (end_dates < year_end)]
 
-    if not sleep_records:
+    if df.empty:
         print(f"No sleep data for {year}.")
         return
 
-    # --- Convert to DataFrame ---
-    df = pd.DataFrame(sleep_records)
-    date_format = "%Y-%m-%d %H:%M:%S %z"
-    df["startDate"] = pd.to_datetime(df["startDate"], format=date_format)
-    df["endDate"] = pd.to_datetime(df["endDate"], format=date_format)
-
     # --- Merge overlapping/consecutive intervals (to treat a full night as one block) ---
-    df_sorted = df.sort_values("startDate").reset_index(drop=True)
-
-    merged = []
-    for i, row in df_sorted.iterrows():
-        start = row["startDate"]
-        end = row["endDate"]
-
-        if not merged:
-            merged.append({'start': start, 'end': end, 'Sleep_Day': end.normalize()})
-        else:
-            last_entry = merged[-1]
-            last_start, last_end = last_entry['start'], last_entry['end']
-            
-            # Merge if the new segment starts before the last segment ends (plus a small buffer, e.g., 5 min)
-            if start <= last_end + timedelta(minutes=5):
-                last_entry['end'] = max(last_end, end)
-            else:
-                merged.append({'start': start, 'end': end, 'Sleep_Day': end.normalize()})
-
-    merged_df = pd.DataFrame(merged)
+    # Segments are already sorted by start (see load_sleep_segments)
+    starts = df["startDate"].astype("int64").to_numpy()
+    ends = df["endDate"].astype("int64").to_numpy()
+
+    block_firsts, block_end_ns, segment_counts = merge_sleep_segments(starts, ends, MERGE_BUFFER_NS)
+
+    merged_df = pd.DataFrame({
+        'start': df["startDate"].array[block_firsts],
+        'end': pd.to_datetime(block_end_ns),
+        # Sleep day comes from the end of the block's first segment
+        'Sleep_Day': df["endDate"].array[block_firsts].normalize(),
+        'Segments': segment_counts,
+    })
     # Filter merged blocks by target year (using the wake-up date)
-    merged_df = merged_df[merged_df["end"].dt.year == year].copy()
+    block_ends = merged_df["end"].to_numpy()
+    merged_df = merged_df[(block_ends >= year_start) & (block_ends < year_end)]
 
     # --- Calculate metrics for merged blocks ---
-    merged_df["Hours_Slept"] = (merged_df["end"] - merged_df["start"]).dt.total_seconds() / 3600.0
-    merged_df["Bed_Time"] = merged_df["start"].dt.time
-    merged_df["Wake_Time"] = merged_df["end"].dt.time
-    
-    # Add adjusted start/end datetime objects for min/max
-    merged_df["start_adj_dt"] = merged_df.apply(create_adjusted_bedtime_dt, axis=1)
+    # Add adjusted start datetime objects for min/max:
+    # if sleep starts after midnight (e.g., 1AM), treat it as 25:00 on the previous day's cycle
+    start = merged_df["start"]
+    merged_df = merged_df.assign(
+        Hours_Slept=(merged_df["end"] - start).dt.total_seconds() / 3600.0,
+        start_adj_dt=start.where(start.dt.hour >= 12, start + pd.Timedelta(days=1)),
+    )
+
+    # Adjusted seconds for mode/std dev; shift bedtime forward 24 hours if it is before noon
+    bed_seconds = local_seconds_of_day(merged_df["start"])
+    bed_seconds_adjusted = np.where(bed_seconds < 43200, bed_seconds + 86400, bed_seconds)
+    wake_seconds = local_seconds_of_day(merged_df["end"])
 
     # --- Daily Sleep Aggregation (One row per unique wake-up day) ---
-    daily_sleep = merged_df.groupby('Sleep_Day')['Hours_Slept'].sum().reset_index()
-    daily_sleep.columns = ["Date", "Hours_Slept"]
+    # Sleep days span at most a year or so, so sum hours into one bucket per day since the first one
+    sleep_days = merged_df["Sleep_Day"].to_numpy().astype("datetime64[D]")
+    day_index = (sleep_days - sleep_days.min()).astype(np.int64)
+    has_data = np.bincount(day_index) > 0
+    day_hours = np.bincount(day_index, weights=merged_df["Hours_Slept"].to_numpy())
+    daily_sleep = pd.DataFrame({
+        "Date": pd.to_datetime(sleep_days.min() + np.flatnonzero(has_data)),
+        "Hours_Slept": day_hours[has_data],
+    })
 
     # FIX: Correct Total Days with Data (uses unique days from the aggregation)
     total_days = len(daily_sleep)
@@ -125,22 +189,11 @@ def analyze_sleep_data(file_path, year):
 
     # --- Bed/Wake Time Metrics (using adjusted seconds) ---
     
-    # Convert time objects to adjusted seconds for mode/std dev
-    merged_df["Bed_Seconds_Adjusted"] = merged_df["Bed_Time"].apply(lambda t: time_to_adjusted_seconds(t, True))
-    merged_df["Wake_Seconds"] = merged_df["Wake_Time"].apply(lambda t: time_to_adjusted_seconds(t, False))
-    
     # --- MODE (Binning to nearest 15 minutes) ---
     bin_size_sec = 900 # 15 minutes
     
-    # FIX: Corrected rounding logic (S / N).round() * N
-    bed_binned_sec = (merged_df["Bed_Seconds_Adjusted"] / bin_size_sec).round() * bin_size_sec
-    wake_binned_sec = (merged_df["Wake_Seconds"] / bin_size_sec).round() * bin_size_sec
-
-    most_common_bed_sec = bed_binned_sec.mode()
-    most_common_wake_sec = wake_binned_sec.mode()
-    
-    most_common_bed = seconds_to_time_str(most_common_bed_sec.iloc[0]) if not most_common_bed_sec.empty else "N/A"
-    most_common_wake = seconds_to_time_str(most_common_wake_sec.iloc[0]) if not most_common_wake_sec.empty else "N/A"
+    most_common_bed = seconds_to_time_str(most_common_bin(bed_seconds_adjusted, bin_size_sec))
+    most_common_wake = seconds_to_time_str(most_common_bin(wake_seconds, bin_size_sec))
 
     # --- Earliest / Latest times (Using full datetime objects) ---
     # Earliest/Latest Bedtime: Find min/max of the adjusted start date
@@ -153,15 +206,14 @@ def analyze_sleep_data(file_path, year):
 
 
     # --- Best & Worst Month ---
-    daily_sleep["Month"] = daily_sleep["Date"].dt.month
-    month_avg = daily_sleep.groupby("Month")["Hours_Slept"].mean()
+    month_avg = daily_sleep.groupby(daily_sleep["Date"].dt.month, sort=False)["Hours_Slept"].mean()
 
     best_month = month_avg.idxmax()
     worst_month = month_avg.idxmin()
 
     # --- Sleep Consistency Score ---
-    bedtime_std = merged_df["Bed_Seconds_Adjusted"].std() / 3600
-    waketime_std = merged_df["Wake_Seconds"].std() / 3600
+    bedtime_std = np.std(bed_seconds_adjusted, ddof=1) / 3600
+    waketime_std = np.std(wake_seconds, ddof=1) / 3600
     consistency_score = bedtime_std + waketime_std
 
     if consistency_score < 1:
@@ -174,30 +226,17 @@ def analyze_sleep_data(file_path, year):
         consistency_label = "Agent of chaos"
 
     # --- Awakenings per night ---
-    awakenings_per_block = []
-
-    for _, block in merged_df.iterrows():
-        start = block["start"]
-        end = block["end"]
-
-        # Count original raw intervals inside this *merged block*
-        raw_segments = df[
-            (df["startDate"] >= start) &
-            (df["endDate"] <= end)
-        ].sort_values("startDate")
-
-        # The number of awakenings is (number of raw segments - 1)
-        # This assumes each segment is separated by an 'Awake' interval
-        awakenings = max(0, len(raw_segments) - 1) 
-        awakenings_per_block.append(awakenings)
+    # The number of awakenings is (number of raw segments - 1)
+    # This assumes each segment is separated by an 'Awake' interval
+    awakenings_per_block = np.maximum(0, merged_df["Segments"].to_numpy() - 1)
 
-    avg_awakenings = float(np.mean(awakenings_per_block)) if awakenings_per_block else 0
-    max_awakenings = int(np.max(awakenings_per_block)) if awakenings_per_block else 0
+    avg_awakenings = float(np.mean(awakenings_per_block)) if awakenings_per_block.size else 0
+    max_awakenings = int(np.max(awakenings_per_block)) if awakenings_per_block.size else 0
 
     # --- Arrays for plotting ---
     sleep_hours_over_year = daily_sleep["Hours_Slept"].tolist()
-    bedtime_over_year = merged_df["Bed_Seconds_Adjusted"].tolist()
-    waketime_over_year = merged_df["Wake_Seconds"].tolist()
+    bedtime_over_year = bed_seconds_adjusted.tolist()
+    waketime_over_year = wake_seconds.tolist()
 
     # === OUTPUT ===
     print("\n## 📊 Sleep Analysis Results for", year)
@@ -242,4 +281,5 @@ def analyze_sleep_data(file_path, year):
 
 
 # Run
-analyze_sleep_data(XML_FILE_PATH, TARGET_YEAR)
\ No newline at end of file
+if __name__ == "__main__":
+    analyze_sleep_data(XML_FILE_PATH, TARGET_YEAR)